@@ -1,25 +1,153 @@
 #!/bin/sh
 
 # NOTE, debootstrap and lsof required for proper built procedure
+#
+# Build environment state after each cached step (see cache_steps) is kept
+# in the step cache keyed by a hash of the step inputs and all the cached
+# steps before it: as snapshots of ${CACHE_DS} ZFS dataset (if set, the
+# build environment is kept in this dataset) or as tarballs in ${CACHEDIR}.
+# Rebuild restores the deepest valid cached step and runs only the steps
+# after it. Remove ${CACHEDIR} (or destroy ${CACHE_DS}) to drop the cache.
 
 set -e
 
 BUILDDIR=${BUILDDIR:-build}
 DEBENV=${BUILDDIR}/env
+CACHEDIR=${CACHEDIR:-cache}
+CACHE_DS=${CACHE_DS:-}
 
 . image/helpers
 
+# files and directories a step depends on (besides its own code)
+step_inputs()
+{
+	case $1 in
+	prep_sources)		echo deb-packages image ;;
+	prep_env)		echo image/helpers ;;
+	build_zfs_packages)	echo deb-packages ;;
+	build_image)		echo image ;;
+	esac
+}
+
+# print step key: hash of previous step key, step code, arguments and inputs
+step_key()
+{
+	cmd=$1
+	inputs=`step_inputs $cmd`
+	{
+		echo ${STEP_KEY}
+		sed -n "/^${cmd}()/,/^}/p" $0
+		echo $*
+		if [ -n "${inputs}" ]; then
+			find ${inputs} -type f | LC_ALL=C sort | xargs -r sha1sum
+		fi
+	} | sha1sum | awk '{print $1}'
+}
+
 do_step()
 {
 	cmd=$1
+	key=`step_key $*`
 	shift
-	if [ -f ${BUILDDIR}/$cmd ]; then
+	if [ "`cat ${BUILDDIR}/$cmd 2>/dev/null`" = "${key}" ]; then
 		echo Skipping $cmd
 		return
 	fi
 	echo [`date --rfc-3339=seconds`] do_step $cmd $* 
-	$cmd $*
-	touch ${BUILDDIR}/$cmd
+	timed $cmd $cmd $*
+	echo ${key} > ${BUILDDIR}/$cmd
+}
+
+cache_exists()
+{
+	key=$1
+	if [ -n "${CACHE_DS}" ]; then
+		zfs list -H -t snapshot ${CACHE_DS}@${key} >/dev/null 2>&1
+	else
+		[ -f ${CACHEDIR}/${key}.tar ]
+	fi
+}
+
+cache_store()
+{
+	env_root=$1
+	key=$2
+	if cache_exists ${key}; then
+		return
+	fi
+	echo [`date --rfc-3339=seconds`] cache_store ${key}
+	if [ -n "${CACHE_DS}" ]; then
+		zfs snapshot ${CACHE_DS}@${key}
+	else
+		mkdir -p ${CACHEDIR}
+		tar -C ${env_root} --one-file-system --numeric-owner -cpf ${CACHEDIR}/${key}.tar.tmp .
+		mv ${CACHEDIR}/${key}.tar.tmp ${CACHEDIR}/${key}.tar
+	fi
+}
+
+cache_restore()
+{
+	env_root=$1
+	key=$2
+	echo [`date --rfc-3339=seconds`] cache_restore ${key}
+	umount_env ${env_root}
+	if [ -n "${CACHE_DS}" ]; then
+		# snapshots of other (no longer valid) step chains are destroyed
+		zfs rollback -r ${CACHE_DS}@${key}
+	else
+		rm -rf ${env_root}
+		mkdir -p ${env_root}
+		tar -C ${env_root} --numeric-owner -xpf ${CACHEDIR}/${key}.tar
+	fi
+}
+
+# run cached steps: restore the deepest cached step and run the rest
+cache_steps()
+{
+	env_root=$1
+	shift
+
+	if [ -n "${CACHE_DS}" ] && ! zfs list -H ${CACHE_DS} >/dev/null 2>&1; then
+		mkdir -p ${env_root}
+		zfs create -p -o mountpoint=`readlink -f ${env_root}` ${CACHE_DS}
+	fi
+	# steps must not run in the directory under an unmounted dataset
+	if [ -n "${CACHE_DS}" ] && [ "`zfs get -H -o value mounted ${CACHE_DS}`" != "yes" ]; then
+		zfs mount ${CACHE_DS}
+	fi
+
+	STEP_KEY=
+	restore=
+	for step in "$@"; do
+		STEP_KEY=`step_key ${step}`
+		if cache_exists ${STEP_KEY}; then
+			restore=${STEP_KEY}
+		fi
+	done
+	if [ -n "${restore}" ] && [ "`cat ${BUILDDIR}/env.key 2>/dev/null`" != "${restore}" ]; then
+		cache_restore ${env_root} ${restore}
+		echo ${restore} > ${BUILDDIR}/env.key
+	fi
+
+	STEP_KEY=
+	skip=${restore:+yes}
+	for step in "$@"; do
+		STEP_KEY=`step_key ${step}`
+		if [ -n "${skip}" ]; then
+			echo Cached ${step}
+			if [ "${STEP_KEY}" = "${restore}" ]; then
+				skip=
+			fi
+			continue
+		fi
+		rm -f ${BUILDDIR}/env.key
+		mount_env ${env_root}
+		echo [`date --rfc-3339=seconds`] do_step ${step}
+		timed ${step%% *} ${step}
+		cache_store ${env_root} ${STEP_KEY}
+		echo ${STEP_KEY} > ${BUILDDIR}/env.key
+	done
+	mount_env ${env_root}
 }
 
 transfer()
@@ -36,10 +164,23 @@ readonly_l0_mount()
 	src=$2
 	dst=${env_root}/$3
 	mkdir -p ${dst}
+	if mountpoint -q ${dst}; then
+		return
+	fi
 	mount --rbind -o ro ${src} ${dst}
 	mount --rbind -o remount,ro ${src} ${dst}
 }
 
+rbind_mount()
+{
+	src=$1
+	dst=$2
+	mkdir -p ${dst}
+	if ! mountpoint -q ${dst}; then
+		mount --rbind ${src} ${dst}
+	fi
+}
+
 prep_sources()
 {
 	build_dir=$1
@@ -52,23 +193,35 @@ prep_sources()
 prep_env()
 {
 	env_root=$1
-	build_dir=$2
 	f_debootstrap ${env_root} --arch=amd64 --variant=minbase wheezy ${env_root} http://debian.volia.net/debian/
+}
 
-	mkdir -p ${env_root}/var/tmp/sources
-	mount --rbind ${build_dir}/sources ${env_root}/var/tmp/sources
+# mount sources and chroot filesystems (not part of the cached state)
+mount_env()
+{
+	env_root=$1
+	if [ ! -d ${env_root}/var/tmp ]; then
+		return	# not bootstrapped yet
+	fi
+	rbind_mount ${BUILDDIR}/sources ${env_root}/var/tmp/sources
 
 	# mount l0 binraies for zfs utilities if any present in l0
 	readonly_l0_mount ${env_root} /sbin /usr/local/sbin
 	readonly_l0_mount ${env_root} /lib /usr/local/lib
+
+	rbind_mount /dev  ${env_root}/dev
+	rbind_mount /proc ${env_root}/proc
+	rbind_mount /sys  ${env_root}/sys
 }
 
-prep_chroot()
+umount_env()
 {
-	env_root=$1
-	mount --rbind /dev  ${env_root}/dev
-	mount --rbind /proc ${env_root}/proc
-	mount --rbind /sys  ${env_root}/sys
+	env_root=`readlink -f $1`
+	if [ -z "${env_root}" ]; then
+		return
+	fi
+	# mount targets under env_root only (deepest first)
+	awk -v root="${env_root}/" 'index($2, root) == 1 {print $2}' /proc/mounts | tac | xargs -I 0 -r umount -l 0
 }
 
 build_zfs_packages()
@@ -121,6 +274,18 @@ du -sh ${BUILDDIR}/zfsroot.img
 du -sh ${BUILDDIR}/zfsroot.img.vmdk.vagrant-vbox.box
 }
 
+# check if any process runs inside env_root
+env_busy()
+{
+	root=`readlink -f $1`
+	for p in /proc/[0-9]*; do
+		if [ "`readlink $p/root 2>/dev/null`" = "${root}" ]; then
+			return 0
+		fi
+	done
+	return 1
+}
+
 cleanup_env()
 {
 	set +e
@@ -130,14 +295,20 @@ cleanup_env()
 
 chroot ${env_root} bash --login ${SHELLX} <<EOF
 	service --status-all 2>&1| awk '/\[ \+ \]/{print \$NF}' |xargs -I 0 -r service 0 stop
-	sleep 5
-	losetup -a | tac | awk '{print \$1}' | sed 's/://' | xargs -r -I 0 kpartx -d 0
+	# stopped services (e.g. zfs-fuse) may hold partition mappings for a while
+	for dev in \`losetup -a | tac | awk '{print \$1}' | sed 's/://'\`; do
+		tries=50
+		until kpartx -d \$dev || [ \$tries -le 0 ]; do
+			tries=\$((tries - 1))
+			sleep 0.1
+		done
+	done
 	losetup -a | tac | awk '{print \$1}' | sed 's/://' | xargs -r -I 0 losetup -d 0
 EOF
 
 	# lsof -P | grep ${env_root} | awk '{print $2'} | sort | uniq | xargs -I 0 -r kill 0
-	# wait a bit after fuse, sshd, atd killed in chroot which locks it
-	sleep 5
+	# wait for fuse, sshd, atd killed in chroot which locks it
+	wait_for 30 "! env_busy ${env_root}"
 	mount | grep ${DEBENV} | tac | awk '{print $3}' | xargs -I 0 -r umount 0
 	set -e
 	mount | grep ${DEBENV} | tac | awk '{print $3}' | xargs -I 0 -r /bin/false
@@ -150,10 +321,9 @@ main()
 	if [ "x${FULL}" = "xyes" ]; then
 		cleanup_env ${DEBENV}
 	fi
+	mkdir -p ${BUILDDIR}
 	do_step prep_sources ${BUILDDIR}
-	do_step prep_env ${DEBENV} ${BUILDDIR}
-	do_step prep_chroot ${DEBENV}
-	do_step build_zfs_packages ${DEBENV}
+	cache_steps ${DEBENV} "prep_env ${DEBENV}" "build_zfs_packages ${DEBENV}"
 	do_step build_image ${DEBENV} ${preset}
 }
 
@@ -57,17 +57,30 @@ convert_image()
 # !!! qcow2 non bootable at least in VBox, but bootable in KVM (libvirt)
     img=$1
     fmt=$2
-    qemu-img convert -f raw -O ${fmt} ${img}.clone ${img}.${fmt} && echo -n ${fmt} disk image created ${img}.${fmt} && du -sh ${img}.${fmt}
+    # -S: do not write zeroed blocks, keep output sparse
+    timed "convert ${fmt}" qemu-img convert -S 4k -f raw -O ${fmt} ${img}.clone ${img}.${fmt}
+    echo -n ${fmt} disk image created ${img}.${fmt} && du -sh ${img}.${fmt}
+    if [ "${fmt}" = "vmdk" ]; then
+        timed "vagrant boxes" make_vagrant_boxes
+    fi
 }
 
+# convert image to all formats at the same time
 convert_images()
 {
     disk=$1
     shift
     to_fmt=$*
+    pids=
     for f in ${to_fmt}; do
-        convert_image $disk $f
+        convert_image $disk $f &
+        pids="${pids} $!"
+    done
+    failed=0
+    for pid in ${pids}; do
+        wait ${pid} || failed=1
     done
+    return ${failed}
 }
 
 make_vagrant_boxes()
@@ -114,13 +127,13 @@ if [ -z "${preset}" ]; then
 fi
 . ${preset}
 EXTRA_PACKAGES=$*
+FORMATS=${FORMATS:-vmdk} #qcow2 vdi qcow...
 
 . `dirname $0`/buildimage-functions
 
-debian_requirements
-build_image ${EXTRA_PACKAGES}
-clone_image
-convert_images ${DISK} vmdk #qcow2 vdi qcow...
-make_vagrant_boxes 
+timed debian_requirements debian_requirements
+timed build_image build_image ${EXTRA_PACKAGES}
+timed clone_image clone_image
+timed convert_images convert_images ${DISK} ${FORMATS}
 
 # vi: set filetype=sh expandtab sw=4 ts=4 :
@@ -5,15 +5,27 @@ import getopt
 import subprocess
 import pipes
 import collections
+import copy
 import json
 import sets
+import shutil
+import signal
+import struct
+import tempfile
 import time
+import threading
+import zlib
 
 try:
     from subprocess import DEVNULL # py3k
 except ImportError:
     DEVNULL = open(os.devnull, 'wb')
 
+try:
+    import queue as Queue # py3k
+except ImportError:
+    import Queue
+
 ###########################################################################
 # globals
 commands = collections.OrderedDict()
@@ -21,8 +33,17 @@ use_sudo = False
 use_debug = False
 use_verbose = False
 use_noop = False
+use_agent = False
 default_all = False
 
+print_lock = threading.Lock()       # serializes output of parallel tasks
+
+STREAM_CHUNK_SIZE = 128 * 1024      # send stream read size
+FANOUT_BUFFER_SIZE = 64 * 1024 * 1024   # per-receiver fan-out buffer
+MULTISTREAM_CHUNK_SIZE = 4 * 1024 * 1024    # multi-stream transport chunk size
+MULTISTREAM_QUEUE_SIZE = 4          # chunks buffered per connection
+MULTISTREAM_CONNECT_TIMEOUT = 60    # seconds to wait for all connections
+
 ###########################################################################
 # utility functions
 def debug(s):
@@ -46,10 +67,12 @@ def hostcmd(host, *args):
     cmd += args
     return cmd
 
-def runcmd(host, *args):
+def runcmd(host, *args, **kwargs):
     """run command on host
 :param host: host to run command on (None for localhost)
 :type host: str
+:param check: exit on command failure (default), return None otherwise
+:type check: bool
 :returns: command stdout
 :rtype: str"""
     try:
@@ -57,9 +80,27 @@ def runcmd(host, *args):
         debug("runcmd: {}".format(" ".join(cmd)))
         return subprocess.check_output(cmd, stderr=DEVNULL)
     except subprocess.CalledProcessError as err:
+        if not kwargs.get("check", True):
+            return None
         print("Command returned exit code {}".format(err.returncode), file=sys.stderr)
         exit(1)
 
+def runpipe(host, *cmds, **kwargs):
+    """run pipeline on host
+:param host: host to run pipeline on (None for localhost)
+:type host: str
+:param cmds: commands (lists of arguments) to connect with pipes
+:returns: pipeline stdout
+:rtype: str"""
+    # the shell returns status of the last command only, so statuses of all
+    # commands are collected on fd 3 and the first failed one is returned
+    cmds = map(lambda x: " ".join(map(pipes.quote, x)), cmds)
+    pipeline = " | ".join(map(lambda x: "{{ {}; echo $? >&3; }}".format(x), cmds[:-1]) +
+        ["{} >&4".format(cmds[-1])])
+    script = 'exec 4>&1; s=$({{ {}; echo $? >&3; }} 3>&1); ' \
+        'for x in $s; do [ "$x" = 0 ] || exit "$x"; done'.format(pipeline)
+    return runcmd(host, "sh", "-c", pipes.quote(script) if host else script, **kwargs)
+
 def runshell(return_output, *args):
     """run command through shell"""
     cmd = ' '.join(map(lambda x:
@@ -76,14 +117,70 @@ def runshell(return_output, *args):
         print("Command returned exit code {}".format(err.returncode), file=sys.stderr)
         exit(1)
 
+def run_parallel(tasks, jobs):
+    """run tasks in parallel (exit if any of them fails)
+:param tasks: callables to run
+:type tasks: list
+:param jobs: max number of tasks to run at the same time
+:type jobs: int
+:returns: task results
+:rtype: list"""
+    results = [None] * len(tasks)
+    failed = []
+    q = Queue.Queue()
+    for task in enumerate(tasks):
+        q.put(task)
+
+    def worker():
+        while True:
+            try:
+                (i, task) = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = task()
+            except BaseException as err:
+                debug("run_parallel: task failed: {!r}".format(err))
+                failed.append(err)
+
+    threads = []
+    for i in range(max(1, min(jobs, len(tasks)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    if failed:
+        sys.exit(1)
+    return results
+
+def parse_size(s):
+    """parse size with optional K/M/G/T suffix
+:param s: size string (e.g. "10G")
+:type s: str
+:returns: size in bytes
+:rtype: int"""
+    units = "KMGT"
+    s = s.strip().upper().rstrip("B")
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * 1024 ** (units.index(s[-1]) + 1))
+    return int(s)
+
 ###########################################################################
 # Filesystem snapshot
 class Snapshot:
-    """Filesystem snapshot"""
+    """Filesystem snapshot (or bookmark)"""
     def __init__(self, name):
         self.name = name            # snapshot name
         self.guid = None            # snapshot guid
         self.createtxg = 0          # snapshot create txn
+        # incremental stream from this snapshot includes intermediate
+        # snapshots (-I), bookmarks can be used only with -i
+        self.intermediates = not self.is_bookmark()
+
+    def is_bookmark(self):
+        return "#" in self.name
 
     def num_changes(self):
         fsname = self.name.split("@")[0]
@@ -97,10 +194,21 @@ class Filesystem:
     """Filesystem object"""
     def __init__(self, name):
         self.name = name            # filesystem name
+        self.origin = None          # origin snapshot name
+        self.mountpoint = None      # mountpoint
         self.parent = None          # parent (origin) filesystem
+        self.filesystems = None     # FS the filesystem belongs to
         self.snapshots = {}         # guid -> snapshot
+        self.bookmarks = {}         # guid -> bookmark
         self.processed = False
 
+    def get_parent(self):
+        """get parent (origin) filesystem
+Origins outside of the listing scope are loaded on demand."""
+        if self.parent is None and self.origin and self.filesystems is not None:
+            self.parent = self.filesystems.load(self.origin.split("@")[0])
+        return self.parent
+
     def first_snapshot(self):
         """get first filesystem snapshot"""
         return next(self.snapshots.itervalues(), None)
@@ -111,6 +219,14 @@ class Filesystem:
             return None
         return self.snapshots[next(reversed(self.snapshots.keys()), None)]
 
+    def find_bookmark(self, recv_filesystems, to_snap):
+        """find latest bookmark older than to_snap which snapshot exists on receiver"""
+        for bookmark in reversed(self.bookmarks.values()):
+            if int(bookmark.createtxg) < int(to_snap.createtxg) and \
+                    recv_filesystems.get_snapshot(bookmark) is not None:
+                return bookmark
+        return None
+
     def find_snapshot(self, snapname, fuzzy=False):
         """find snapshot by name"""
         for snap in reversed(self.snapshots.values()):
@@ -120,53 +236,53 @@ class Filesystem:
                 return snap
         return None
 
-    def sync(self, send_filesystems, recv_filesystems, recv_parent_fs):
+    def plan(self, recv_filesystems, steps):
+        """append send steps required to sync filesystem to receiver
+:param recv_filesystems: receiver filesystems
+:type recv_filesystems: FS
+:param steps: list to append (from_snap, to_snap) steps to
+:type steps: list"""
         if not self.snapshots:
             debug("{}: empty snapshot list".format(self.name))
             return
         if self.processed:
-            debug("Filesystem {} is already synced, skipping".format(self.name))
+            debug("Filesystem {} is already planned, skipping".format(self.name))
             return
         #debug("self.snapshots: {}".format(self.snapshots.keys()))
 
-        def sync_snapshot(from_snap, to_snap):
-            cmd = hostcmd(send_filesystems.host, "zfs", "send", "-p", "-P")
-            if use_verbose:
-                cmd += ["-v"]
-            if use_noop:
-                cmd += ["-n"]
-            if from_snap:
-                cmd += ["-I", from_snap.name]
-            cmd += [to_snap.name]
-
-            if not use_noop:
-                cmd += ["|"]
-                cmd += hostcmd(recv_filesystems.host, "zfs", "recv", "-F", "-u")
-                if use_verbose:
-                    cmd += ["-v"]
-                if recv_parent_fs:
-                    cmd += ["-d", recv_parent_fs]
-                else:
-                    cmd += [to_snap.name.split("@")[0]]
-
-            runshell(None, *cmd)
+        debug("==> Planning filesystem {}".format(self.name))
 
-        debug("==> Syncing filesystem {}".format(self.name))
+        # snapshots older than the newest one on receiver can't be received
+        # any more (e.g. skipped by catch-up), treat them as synced
+        last_synced = 0
+        for snap in self.snapshots.itervalues():
+            if recv_filesystems.get_snapshot(snap) is not None:
+                last_synced = int(snap.createtxg)
+        def missing(snap):
+            return recv_filesystems.get_snapshot(snap) is None and \
+                int(snap.createtxg) > last_synced
 
         # sync first snapshot
         snapshot_iter = self.snapshots.itervalues()
         to_snap = next(snapshot_iter)
-        if recv_filesystems.get_snapshot(to_snap) is None:
+        if missing(to_snap):
             debug("--> first snapshot {} (guid {}) does not exist on receiver".format(
                 to_snap.name, to_snap.guid))
-            if self.parent:
+            bookmark = self.find_bookmark(recv_filesystems, to_snap)
+            parent = self.get_parent()
+            if bookmark:
+                # sync incrementally from bookmark of destroyed snapshot
+                debug("--> bookmark {} (guid {}) exists on receiver".format(
+                    bookmark.name, bookmark.guid))
+                steps.append((bookmark, to_snap))
+            elif parent:
                 # sync from parent incrementally
-                self.parent.sync(send_filesystems, recv_filesystems, recv_parent_fs)
-                from_snap = None #self.parent.last_snapshot()
+                recv_filesystems.load(recv_filesystems.recv_name(parent.name))
+                parent.plan(recv_filesystems, steps)
+                steps.append((None, to_snap)) #self.parent.last_snapshot()
             else:
                 # sync base version
-                from_snap = None
-            sync_snapshot(from_snap, to_snap)
+                steps.append((None, to_snap))
         else:
             debug("--> first snapshot {} (guid {}) exists on receiver".format(
                 to_snap.name, to_snap.guid))
@@ -177,7 +293,7 @@ class Filesystem:
             # find next missing snapshot (move from_snap)
             from_snap = next_from
             for snap in snapshot_iter:
-                if recv_filesystems.get_snapshot(snap) is None:
+                if missing(snap):
                     debug("sync to: snapshot {} (guid {})".format(snap.name, snap.guid))
                     to_snap = snap
                     break
@@ -189,7 +305,7 @@ class Filesystem:
 
             # find next existing snapshot (move to_snap)
             for snap in snapshot_iter:
-                if recv_filesystems.get_snapshot(snap) is not None:
+                if not missing(snap):
                     debug("sync from: snapshot {} (guid {})".format(snap.name, snap.guid))
                     next_from = snap    # next from snap
                     break
@@ -199,9 +315,9 @@ class Filesystem:
             # sync snapshots
             debug("--> snapshot {} (guid {}) does not exist on receiver".format(
                 to_snap.name, to_snap.guid))
-            sync_snapshot(from_snap, to_snap)
+            steps.append((from_snap, to_snap))
 
-        debug("==> Filesystem {} synced".format(self.name))
+        debug("==> Filesystem {} planned".format(self.name))
         self.processed = True
 
 ###########################################################################
@@ -210,22 +326,97 @@ class FS(dict):
     """dict of filesystems (key: name)"""
     def __init__(self, host):
         self.host = host            # host
+        self.scoped = False         # not all filesystems are listed
+        self.read_bookmarks = False # read filesystem bookmarks
+        self.recv_parent_fs = None  # receive parent fs (for name mapping)
         self.snapshots = {}         # guid -> Filesystem
         self.mountpoints = {}       # mountpoint -> Filesystem
 
     def get_snapshot(self, snap):
         return self.snapshots.get(snap.guid)
 
-    @staticmethod
-    def list(host):
-        """list filesystems on host
-:param host: host to list filesystems on (localhost if None)
-:type host: str
-:returns: filesystems on specified host
-:rtype: dict of Filesystems (by name)"""
+    def recv_name(self, fsname):
+        """map sender filesystem name to the name it is received as"""
+        if not self.recv_parent_fs:
+            return fsname
+        (pool, sep, rest) = fsname.partition("/")
+        return self.recv_parent_fs + sep + rest
+
+    def load(self, fsname):
+        """get filesystem, loading it if it is out of listing scope
+:returns: filesystem (None if it does not exist)
+:rtype: Filesystem"""
+        if fsname in self or not self.scoped:
+            return self.get(fsname)
+        debug("loading filesystem {}".format(fsname))
+        if not self.read(fsname, depth=0, check=False):
+            return None
+        return self.get(fsname)
+
+    def read(self, root=None, depth=None, name=None, check=True):
+        """read filesystems and their snapshots
+:param root: read only filesystems under root (None - all pools)
+:type root: str
+:param depth: limit recursion depth below root
+:type depth: int
+:param name: read only datasets with name containing specified string
+:type name: str
+:returns: False if listing failed and check is False
+:rtype: bool"""
+        if self.host and use_agent and depth is None:
+            args = ["-b"] if self.read_bookmarks else []
+            if root:
+                args += ["-r", root]
+            if name:
+                args += ["-n", name]
+            data = run_agent(self.host, *args, check=check)
+            if data is None:
+                return False
+            self.load_dump(data)
+            return True
+
+        def zfs_get(dataset_type, props, check=check):
+            cmd = ["zfs", "get", "-H", "-p", "-o", "name,property,value", "-t", dataset_type]
+            if root:
+                cmd += ["-r"]
+                if depth is not None:
+                    # snapshots are one level deeper than their filesystem
+                    cmd += ["-d", str(depth + (dataset_type != "filesystem"))]
+            cmd += [props]
+            if root:
+                cmd += [root]
+            if not name:
+                return runcmd(self.host, *cmd, check=check)
+            # filter on the remote side (superset of the name match)
+            awk = ["awk", "-F", "\t", "-v", "n=" + name, "index($1, n)"]
+            return runpipe(self.host, cmd, awk, check=check)
+
+        def read_snapshots(output, sep, attr):
+            for l in output.split("\n"):
+                # pool/src/OpenVZ@pool-src-OpenVZ-20150529-Initial  createtxg   1379    -
+                if not l:
+                    continue
+                #debug(l)
+                (snapname, propname, value) = l.split("\t")
+                if value == "-":
+                    continue    # empty value
+
+                fsname = snapname.split(sep)[0]
+                fs = new_filesystems.get(fsname)
+                if fs is None:
+                    continue    # filtered out or already read
+                snapshots = getattr(fs, attr)
+                if propname == "guid":
+                    guid = value
+                    snapshots[guid] = Snapshot(snapname)
+                setattr(snapshots[guid], propname, value)
+
         # get filesystem origins
-        filesystems = FS(host)
-        for l in runcmd(host, "zfs", "get", "-H", "-p", "-o", "name,property,value", "-t", "filesystem", "origin,mountpoint").split("\n"):
+        output = zfs_get("filesystem", "origin,mountpoint")
+        if output is None:
+            return False
+        new_filesystems = collections.OrderedDict()
+        for l in output.split("\n"):
             # pool/vm/Root3   origin  pool/vm/Root2@zfs-vm:foo:6
             if not l:
                 continue
@@ -234,40 +425,657 @@ class FS(dict):
             if value == "-":
                 value = None
             if propname == "origin":
-                filesystems[fsname] = Filesystem(fsname)
-            setattr(filesystems[fsname], propname, value)
+                if fsname in self:
+                    continue
+                self[fsname] = Filesystem(fsname)
+                new_filesystems[fsname] = self[fsname]
+            setattr(self[fsname], propname, value)
 
         # get filesystem snapshots
-        for l in runcmd(host, "zfs", "get", "-H", "-p", "-o", "name,property,value", "-t", "snapshot", "guid,createtxg").split("\n"):
-            # pool/src/OpenVZ@pool-src-OpenVZ-20150529-Initial  createtxg   1379    -
-            if not l:
-                continue
-            #debug(l)
-            (snapname, propname, value) = l.split("\t")
-            if value == "-":
-                continue    # empty value
-
-            fsname = snapname.split("@")[0]
-            fs = filesystems[fsname]
-            if propname == "guid":
-                guid = value
-                fs.snapshots[guid] = Snapshot(snapname)
-            setattr(fs.snapshots[guid], propname, value)
+        output = zfs_get("snapshot", "guid,createtxg")
+        if output is None:
+            return False
+        read_snapshots(output, "@", "snapshots")
+
+        # get filesystem bookmarks (not supported by older zfs versions)
+        if self.read_bookmarks:
+            output = zfs_get("bookmark", "guid,createtxg", check=False)
+            if output is not None:
+                read_snapshots(output, "#", "bookmarks")
+
+        self.link(new_filesystems)
+        return True
 
-        # build parent relation, snapshots and mountpoints dicts
-        for fs in filesystems.itervalues():
+    def link(self, new_filesystems):
+        """build parent relation, snapshots and mountpoints dicts for
+newly read filesystems"""
+        for fs in new_filesystems.itervalues():
+            fs.filesystems = self
             if fs.origin:
-                fs.parent = filesystems.get(fs.origin.split("@")[0])
+                fs.parent = self.get(fs.origin.split("@")[0])
             for snap in fs.snapshots.itervalues():
-                filesystems.snapshots[snap.guid] = fs
+                self.snapshots[snap.guid] = fs
             if fs.mountpoint:
-                filesystems.mountpoints[fs.mountpoint] = fs
-            # sort Filesystem snapshots by "createtxg"
+                self.mountpoints[fs.mountpoint] = fs
+            # sort Filesystem snapshots and bookmarks by "createtxg"
             fs.snapshots = collections.OrderedDict(
                 sorted(fs.snapshots.items(), key=lambda x: int(x[1].createtxg)))
+            fs.bookmarks = collections.OrderedDict(
+                sorted(fs.bookmarks.items(), key=lambda x: int(x[1].createtxg)))
+
+    def dump(self):
+        """get compact inventory of filesystems, snapshots and bookmarks
+:rtype: dict"""
+        fs_list = self.values()
+        index = dict((fs.name, i) for (i, fs) in enumerate(fs_list))
+        def snapshots(attr, sep):
+            return [[index[fs.name], snap.name.split(sep)[1], snap.guid, int(snap.createtxg)]
+                for fs in fs_list for snap in getattr(fs, attr).itervalues()]
+        return {
+            "fs": [[fs.name, fs.origin, fs.mountpoint] for fs in fs_list],
+            "snap": snapshots("snapshots", "@"),
+            "bm": snapshots("bookmarks", "#"),
+        }
+
+    def load_dump(self, data):
+        """add filesystems from inventory made by dump()"""
+        new_filesystems = collections.OrderedDict()
+        fs_list = []
+        for (fsname, origin, mountpoint) in data["fs"]:
+            fs = Filesystem(str(fsname))
+            fs.origin = str(origin) if origin else None
+            fs.mountpoint = str(mountpoint) if mountpoint else None
+            fs_list.append(fs)
+            if fsname not in self:
+                self[fs.name] = new_filesystems[fs.name] = fs
+        for (attr, sep) in (("snapshots", "@"), ("bookmarks", "#")):
+            for (i, name, guid, createtxg) in data["bm" if sep == "#" else "snap"]:
+                snap = Snapshot(str(fs_list[i].name + sep + name))
+                snap.guid = str(guid)
+                snap.createtxg = str(createtxg)
+                getattr(fs_list[i], attr)[snap.guid] = snap
+        self.link(new_filesystems)
 
+    @staticmethod
+    def list(host, root=None, name=None, bookmarks=False):
+        """list filesystems on host
+:param host: host to list filesystems on (localhost if None)
+:type host: str
+:param root: list only filesystems under root (None - all pools)
+:type root: str
+:param name: list only filesystems with name containing specified string
+(origins of listed filesystems are loaded on demand)
+:type name: str
+:param bookmarks: list filesystem bookmarks too
+:type bookmarks: bool
+:returns: filesystems on specified host
+:rtype: dict of Filesystems (by name)"""
+        filesystems = FS(host)
+        filesystems.scoped = bool(root or name)
+        filesystems.read_bookmarks = bookmarks
+        filesystems.read(root, name=name)
         return filesystems
 
+###########################################################################
+# inventory agent
+def run_script(host, *args, **kwargs):
+    """start this script on host
+The script is sent to the remote python through ssh.
+:param args: script arguments
+:param kwargs: subprocess.Popen arguments
+:returns: started process
+:rtype: subprocess.Popen"""
+    script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    cmd = hostcmd(host, "python", "-", *args)
+    debug("run_script: {}".format(" ".join(cmd)))
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, **kwargs)
+    p.stdin.write(open(script, "rb").read())
+    p.stdin.close()
+    return p
+
+def run_agent(host, *args, **kwargs):
+    """run zfs-vm inventory agent on host
+The agent is this script sent to the remote python through ssh, it returns
+compressed inventory in one round trip.
+:param check: exit on agent failure (default), return None otherwise
+:type check: bool
+:returns: inventory
+:rtype: dict"""
+    p = run_script(host, "agent", *args, stdout=subprocess.PIPE, stderr=DEVNULL)
+    output = p.stdout.read()
+    if p.wait() != 0:
+        if not kwargs.get("check", True):
+            return None
+        print("Command returned exit code {}".format(p.returncode), file=sys.stderr)
+        exit(1)
+    debug("run_agent: {} bytes received".format(len(output)))
+    return json.loads(zlib.decompress(output))
+
+###########################################################################
+# send/recv
+def send_cmd(send_host, from_snap, to_snap):
+    """generate zfs send command"""
+    cmd = hostcmd(send_host, "zfs", "send", "-p", "-P")
+    if use_verbose:
+        cmd += ["-v"]
+    if use_noop:
+        cmd += ["-n"]
+    if from_snap:
+        cmd += ["-I" if from_snap.intermediates else "-i", from_snap.name]
+    cmd += [to_snap.name]
+    return cmd
+
+def send_size(send_host, from_snap, to_snap):
+    """estimate send stream size
+:returns: stream size in bytes (0 if unknown)
+:rtype: int"""
+    cmd = ["zfs", "send", "-n", "-P"]
+    if from_snap:
+        cmd += ["-I" if from_snap.intermediates else "-i", from_snap.name]
+    output = runcmd(send_host, *(cmd + [to_snap.name]), check=False)
+    for l in (output or "").split("\n"):
+        # size	1046512
+        fields = l.split("\t")
+        if fields[0] == "size" and len(fields) > 1 and fields[1].isdigit():
+            return int(fields[1])
+    return 0
+
+def bookmark_snapshot(host, snap):
+    """bookmark replicated snapshot so it can be the incremental source
+after it is destroyed"""
+    if use_noop:
+        return
+    bookmark = snap.name.replace("@", "#")
+    debug("bookmark: {}".format(bookmark))
+    # bookmark may exist already or be not supported by the pool
+    runcmd(host, "zfs", "bookmark", snap.name, bookmark, check=False)
+
+def recv_cmd(recv_host, recv_parent_fs, to_snap):
+    """generate zfs recv command"""
+    cmd = hostcmd(recv_host, "zfs", "recv", "-F", "-u")
+    if use_verbose:
+        cmd += ["-v"]
+    if recv_parent_fs:
+        cmd += ["-d", recv_parent_fs]
+    else:
+        cmd += [to_snap.name.split("@")[0]]
+    return cmd
+
+def tee_stream(src, dsts, bufsize=FANOUT_BUFFER_SIZE):
+    """copy stream to several destinations
+Each destination is written by its own thread through a bounded queue,
+so a slow destination stalls the source only when its buffer is full.
+:param src: source stream
+:type src: file
+:param dsts: destination streams
+:type dsts: list of file
+:returns: write status for each destination
+:rtype: list of bool"""
+    def writer(i, q, dst):
+        while True:
+            chunk = q.get()
+            if chunk is None:
+                break
+            if not ok[i]:
+                continue    # keep draining so the source is not blocked
+            try:
+                dst.write(chunk)
+            except IOError as err:
+                debug("tee_stream: write failed: {}".format(err))
+                ok[i] = False
+        try:
+            dst.close()
+        except IOError:
+            ok[i] = False
+
+    ok = [True] * len(dsts)
+    queues, threads = [], []
+    for (i, dst) in enumerate(dsts):
+        q = Queue.Queue(max(1, bufsize // STREAM_CHUNK_SIZE))
+        t = threading.Thread(target=writer, args=(i, q, dst))
+        t.daemon = True
+        t.start()
+        queues.append(q)
+        threads.append(t)
+
+    while True:
+        chunk = src.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        for q in queues:
+            q.put(chunk)
+    for q in queues:
+        q.put(None)
+    for t in threads:
+        t.join()
+    return ok
+
+###########################################################################
+# multi-stream transport
+# The stream is split into sequenced chunks sent round-robin over several
+# connections, each chunk is prefixed by its sequence number and length.
+# Zero length chunk ends the stream.
+FRAME_HEADER = struct.Struct(">QI")
+
+def split_stream(src, dsts, chunk_size=MULTISTREAM_CHUNK_SIZE):
+    """split stream to sequenced chunks written round-robin to destinations
+Each destination is written by its own thread through a bounded queue.
+:param src: source stream
+:type src: file
+:param dsts: destination streams (connections)
+:type dsts: list of file
+:returns: True if the whole stream is written
+:rtype: bool"""
+    def writer(i, q, dst):
+        while True:
+            frame = q.get()
+            if frame is None:
+                break
+            if not ok[i]:
+                continue    # keep draining so the source is not blocked
+            try:
+                dst.write(frame[0])
+                dst.write(frame[1])
+            except IOError as err:
+                debug("split_stream: write failed: {}".format(err))
+                ok[i] = False
+        try:
+            dst.close()
+        except IOError:
+            ok[i] = False
+
+    ok = [True] * len(dsts)
+    queues, threads = [], []
+    for (i, dst) in enumerate(dsts):
+        q = Queue.Queue(MULTISTREAM_QUEUE_SIZE)
+        t = threading.Thread(target=writer, args=(i, q, dst))
+        t.daemon = True
+        t.start()
+        queues.append(q)
+        threads.append(t)
+
+    seq = 0
+    while all(ok):
+        chunk = src.read(chunk_size)
+        frame = (FRAME_HEADER.pack(seq, len(chunk)), chunk)
+        # a connection may stall when another one fails, re-check status
+        while all(ok):
+            try:
+                queues[seq % len(queues)].put(frame, timeout=1)
+                break
+            except Queue.Full:
+                pass
+        if not chunk:
+            break
+        seq += 1
+    if not all(ok):
+        # writers blocked on stalled connections are released by the caller
+        # terminating the connections
+        return False
+    for q in queues:
+        q.put(None)
+    for t in threads:
+        t.join()
+    return all(ok)
+
+def join_stream(srcs, dst):
+    """join sequenced chunks read from sources (see split_stream)
+Each source is read by its own thread through a bounded queue.
+:param srcs: source streams (connections)
+:type srcs: list of file
+:param dst: destination stream
+:type dst: file
+:returns: True if the whole stream is joined
+:rtype: bool"""
+    def reader(q, src):
+        try:
+            while True:
+                header = src.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    break
+                (seq, length) = FRAME_HEADER.unpack(header)
+                chunk = src.read(length)
+                if len(chunk) < length:
+                    break
+                q.put((seq, chunk))
+                if not length:
+                    break
+        except IOError as err:
+            debug("join_stream: read failed: {}".format(err))
+        q.put(None)
+
+    queues = []
+    for src in srcs:
+        q = Queue.Queue(MULTISTREAM_QUEUE_SIZE)
+        t = threading.Thread(target=reader, args=(q, src))
+        t.daemon = True
+        t.start()
+        queues.append(q)
+
+    seq = 0
+    while True:
+        # wait with timeout to stay interruptible by signals
+        while True:
+            try:
+                frame = queues[seq % len(queues)].get(timeout=1)
+                break
+            except Queue.Empty:
+                pass
+        if frame is None or frame[0] != seq:
+            debug("join_stream: chunk {} is missing".format(seq))
+            return False
+        if not frame[1]:
+            return True
+        try:
+            dst.write(frame[1])
+        except IOError as err:
+            debug("join_stream: write failed: {}".format(err))
+            return False
+        seq += 1
+
+def multistream(host, streams, local_cmd, remote_cmd, push=True):
+    """run local_cmd | remote_cmd (push) or remote_cmd | local_cmd (pull)
+with the stream carried by several ssh connections to host
+The remote side is the stream command of this script: it creates a fifo
+for each connection and splits or joins the stream of remote_cmd.
+:param streams: number of connections
+:type streams: int
+:returns: True on success
+:rtype: bool"""
+    remote = run_script(host, "stream", "-n", str(streams), "join" if push else "split",
+        *remote_cmd, stdout=subprocess.PIPE)
+    path = remote.stdout.readline().strip()
+    if not path:
+        remote.wait()
+        print("Command returned exit code {}".format(remote.returncode), file=sys.stderr)
+        return False
+    fifos = map(lambda x: "{}/{}".format(path, x), range(streams))
+    debug("multistream: {} connections to {}:{}".format(streams, host, path))
+
+    if push:
+        conns = map(lambda x: subprocess.Popen(hostcmd(host, "sh", "-c",
+            pipes.quote("cat > " + x)), stdin=subprocess.PIPE), fifos)
+        local = subprocess.Popen(local_cmd, stdout=subprocess.PIPE)
+        ok = split_stream(local.stdout, map(lambda x: x.stdin, conns))
+        local.stdout.close()
+    else:
+        conns = map(lambda x: subprocess.Popen(hostcmd(host, "cat", x),
+            stdout=subprocess.PIPE), fifos)
+        local = subprocess.Popen(local_cmd, stdin=subprocess.PIPE)
+        ok = join_stream(map(lambda x: x.stdout, conns), local.stdin)
+        local.stdin.close()
+    if not ok:
+        # stop connections (and remote side) possibly blocked on each other
+        for p in conns + [remote]:
+            if p.poll() is None:
+                p.terminate()
+
+    for p in [local] + conns + [remote]:
+        if p.wait() != 0:
+            print("Command returned exit code {}".format(p.returncode), file=sys.stderr)
+            ok = False
+    return ok
+
+class StreamCache:
+    """directory of send streams (key: from guid, to guid)
+Streams are evicted in least recently used order when the total size
+exceeds max_size (None - unbounded)."""
+    SUFFIX = ".zstream"
+
+    def __init__(self, path, max_size=None):
+        self.path = path            # cache directory
+        self.max_size = max_size    # max total size in bytes
+        if not use_noop and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, from_snap, to_snap):
+        """get stream filename"""
+        if from_snap is None:
+            name = "0-{}".format(to_snap.guid)
+        elif not from_snap.intermediates:
+            name = "{}-i-{}".format(from_snap.guid, to_snap.guid)
+        else:
+            name = "{}-{}".format(from_snap.guid, to_snap.guid)
+        return os.path.join(self.path, name + self.SUFFIX)
+
+    def get(self, from_snap, to_snap):
+        """get cached stream filename (None if not cached)"""
+        filename = self.filename(from_snap, to_snap)
+        if not os.path.isfile(filename):
+            return None
+        os.utime(filename, None)    # mark as recently used
+        return filename
+
+    def open(self, from_snap, to_snap):
+        """open temporary file to store stream to"""
+        return open(self.filename(from_snap, to_snap) + ".tmp", "wb")
+
+    def commit(self, from_snap, to_snap, ok):
+        """move stored stream into the cache (or discard it if not ok)"""
+        filename = self.filename(from_snap, to_snap)
+        if not ok:
+            os.unlink(filename + ".tmp")
+            return
+        os.rename(filename + ".tmp", filename)
+        debug("stream cache: stored {}".format(filename))
+        self.evict(filename)
+
+    def evict(self, keep=None):
+        """evict least recently used streams until cache fits max_size"""
+        if self.max_size is None:
+            return
+        streams = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.SUFFIX):
+                continue
+            filename = os.path.join(self.path, name)
+            st = os.stat(filename)
+            streams.append((st.st_mtime, st.st_size, filename))
+        total = sum(map(lambda x: x[1], streams))
+        for (mtime, size, filename) in sorted(streams):
+            if total <= self.max_size:
+                break
+            if filename == keep:
+                continue
+            debug("stream cache: evicting {}".format(filename))
+            os.unlink(filename)
+            total -= size
+
+def sync_snapshot(send_host, recv_hosts, recv_parent_fs, from_snap, to_snap, cache=None, streams=1):
+    """send snapshot stream to one or more receivers
+:param send_host: sender host (None for localhost)
+:type send_host: str
+:param recv_hosts: receiver hosts (None for localhost)
+:type recv_hosts: list of str
+:param cache: stream cache to replay stream from or store it to
+:type cache: StreamCache
+:param streams: number of connections to carry full send stream to
+a single remote receiver (or from remote sender)
+:type streams: int"""
+    cached = cache.get(from_snap, to_snap) if cache else None
+    if cached:
+        debug("stream cache: replaying {}".format(cached))
+        cmd = ["cat", cached]
+    else:
+        cmd = send_cmd(send_host, from_snap, to_snap)
+    if use_noop:
+        if cached:
+            print(' '.join(cmd))
+        else:
+            runshell(None, *cmd)
+        return
+    if streams > 1 and from_snap is None and len(recv_hosts) == 1 and cache is None and \
+            (send_host or recv_hosts[0]):
+        # large full send: split the stream over several connections
+        # (remote_cmd is run by the stream command on the remote host)
+        if send_host:
+            push = False
+            local_cmd = recv_cmd(None, recv_parent_fs, to_snap)
+            remote_cmd = send_cmd(None, from_snap, to_snap)
+        else:
+            push = True
+            local_cmd = cmd
+            remote_cmd = recv_cmd(None, recv_parent_fs, to_snap)
+        if not multistream(send_host or recv_hosts[0], streams, local_cmd, remote_cmd, push):
+            exit(1)
+        bookmark_snapshot(send_host, to_snap)
+        return
+    if len(recv_hosts) == 1 and cache is None:
+        cmd += ["|"]
+        cmd += recv_cmd(recv_hosts[0], recv_parent_fs, to_snap)
+        runshell(None, *cmd)
+        bookmark_snapshot(send_host, to_snap)
+        return
+
+    # fan-out: one send stream, several receivers (and the cache)
+    debug("sync_snapshot: {} -> {}".format(" ".join(cmd), ", ".join(
+        map(lambda x: x or "localhost", recv_hosts))))
+    if cached:
+        sender = None
+        stream = open(cached, "rb")
+    else:
+        sender = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        stream = sender.stdout
+    receivers = []
+    for recv_host in recv_hosts:
+        rcmd = recv_cmd(recv_host, recv_parent_fs, to_snap)
+        debug("sync_snapshot: recv {}".format(" ".join(rcmd)))
+        receivers.append(subprocess.Popen(rcmd, stdin=subprocess.PIPE))
+    dsts = map(lambda x: x.stdin, receivers)
+    if cache and not cached:
+        dsts.append(cache.open(from_snap, to_snap))
+    ok = tee_stream(stream, dsts)
+    stream.close()
+
+    failed = False
+    for p in filter(None, [sender] + receivers):
+        if p.wait() != 0:
+            print("Command returned exit code {}".format(p.returncode), file=sys.stderr)
+            failed = True
+    if cache and not cached:
+        cache.commit(from_snap, to_snap, ok[-1] and sender.returncode == 0)
+    if failed:
+        exit(1)
+    bookmark_snapshot(send_host, to_snap)
+
+def sync_plans(send_host, plans, recv_parent_fs, cache=None, streams=1):
+    """execute per-receiver sync plans sharing send streams
+Receivers that need the same (from_snap, to_snap) step at the same time
+are fed from a single zfs send.
+:param plans: receiver host -> list of (from_snap, to_snap) steps
+:type plans: OrderedDict
+:param streams: number of connections to carry full send streams
+:type streams: int"""
+    def step_key(step):
+        (from_snap, to_snap) = step
+        if from_snap is None:
+            return (None, to_snap.guid)
+        return (from_snap.guid, from_snap.intermediates, to_snap.guid)
+
+    pending = collections.OrderedDict(
+        (host, list(steps)) for (host, steps) in plans.iteritems() if steps)
+    while pending:
+        # pick the step most receivers are waiting for
+        heads = collections.OrderedDict()
+        for (host, steps) in pending.iteritems():
+            heads.setdefault(step_key(steps[0]), []).append(host)
+        key = max(heads, key=lambda x: len(heads[x]))
+        hosts = heads[key]
+        (from_snap, to_snap) = pending[hosts[0]][0]
+        sync_snapshot(send_host, hosts, recv_parent_fs, from_snap, to_snap, cache, streams)
+        for host in hosts:
+            del pending[host][0]
+            if not pending[host]:
+                del pending[host]
+
+def list_receiver(recv_host, recv_parent_fs=None, root=None, name=None):
+    """list receiver filesystems
+:param recv_parent_fs: receive parent fs
+:type recv_parent_fs: str
+:param root: sender listing scope (receiver is listed within the scope
+the sender's root is received to)
+:type root: str
+:param name: sender name filter (receiver is listed with the filter mapped
+to received names, parents are loaded on demand)
+:type name: str
+:rtype: FS"""
+    recv_filesystems = FS(recv_host)
+    recv_filesystems.recv_parent_fs = recv_parent_fs
+    if name:
+        recv_filesystems.scoped = True
+        if recv_parent_fs and "/" in name:
+            # the pool part of the name is replaced by recv_parent_fs, filter
+            # by the rest (superset of the received names)
+            name = name.partition("/")[2]
+    if root:
+        recv_filesystems.scoped = True
+        recv_filesystems.read(recv_filesystems.recv_name(root), name=name, check=False)
+    else:
+        recv_filesystems.read(name=name)
+    return recv_filesystems
+
+def plan_sync(send_filesystems, recv_filesystems, name=None, keep=None):
+    """plan send steps required to sync filesystems to receiver
+:param name: plan only filesystems with name containing specified string
+:type name: str
+:param keep: catch up - send only the specified number of newest missing
+snapshots of each filesystem (None - send all missing snapshots)
+:type keep: int
+:returns: (from_snap, to_snap) steps
+:rtype: list"""
+    steps = []
+    for s in send_filesystems.values():
+        s.processed = False
+    for s in send_filesystems.values():
+        if name and name not in s.name:
+            continue
+        s.plan(recv_filesystems, steps)
+    if keep:
+        steps = catch_up(send_filesystems, recv_filesystems, steps, keep)
+    return steps
+
+def catch_up(send_filesystems, recv_filesystems, steps, keep):
+    """replace incremental steps replaying all intermediate snapshots (-I)
+by single incrementals (-i) to the newest `keep` of them
+Full or bookmark step to the oldest snapshot is merged into the following
+incremental step, so it goes straight to the newest snapshots too.
+:returns: (from_snap, to_snap) steps
+:rtype: list"""
+    host = send_filesystems.host
+    new_steps = []
+    for (from_snap, to_snap) in steps:
+        if from_snap is None or not from_snap.intermediates:
+            new_steps.append((from_snap, to_snap))
+            continue
+        fs = send_filesystems[to_snap.name.split("@")[0]]
+        snaps = filter(lambda x: int(from_snap.createtxg) < int(x.createtxg) <= int(to_snap.createtxg),
+            fs.snapshots.values())
+        replaced = [(from_snap, to_snap)]
+        source = from_snap
+        if new_steps and new_steps[-1][1] is from_snap and \
+                (new_steps[-1][0] is None or new_steps[-1][0].is_bookmark()):
+            # the oldest snapshot is sent only to be the incremental source
+            replaced.insert(0, new_steps.pop())
+            source = replaced[0][0]
+            snaps.insert(0, from_snap)
+
+        thinned = []
+        for snap in snaps[-keep:]:
+            if source is not None and source.intermediates:
+                source = copy.copy(source)
+                source.intermediates = False
+            thinned.append((source, snap))
+            source = snap
+
+        # report what is saved compared to full replay
+        replay_size = sum(map(lambda x: send_size(host, *x), replaced))
+        size = sum(map(lambda x: send_size(host, *x), thinned))
+        print("{}: {}: catch up {} of {} snapshots, {} instead of {} bytes ({} saved)".format(
+            recv_filesystems.host or "localhost", fs.name, len(thinned), len(snaps),
+            size, replay_size, max(replay_size - size, 0)))
+        new_steps += thinned
+    return new_steps
+
 ###########################################################################
 # VM
 class VM(dict):
@@ -278,6 +1086,12 @@ class VM(dict):
     def __init__(self):
         self.names = {}   # name -> container
 
+    def find(self, id):
+        """find container by ctid or name"""
+        if id in self:
+            return self[id]
+        return self.names.get(id)
+
     @staticmethod
     def list():
         filesystems = FS.list(None)
@@ -310,33 +1124,102 @@ class VM(dict):
 
 def do_sync(cmd, args):
     try:
-        opts, args = getopt.getopt(args, "d:n:")
+        opts, args = getopt.getopt(args, "c:C:d:E:M:n:P:r:" if cmd == cmd_push else "c:C:d:M:n:P:r:")
     except getopt.GetoptError as err:
         usage(cmd, err)
-    name, recv_parent_fs = None, None
+    name, recv_parent_fs, root, keep = None, None, None, None
+    streams = 1
+    cache_dir, cache_size, export_dir = None, None, None
     for o, a in opts:
-        if o == "-n":
+        if o == "-c":
+            if not a.isdigit() or int(a) < 1:
+                usage(cmd, "invalid number of snapshots to keep: {}".format(a))
+            keep = int(a)
+        elif o == "-n":
             name = a
+        elif o == "-r":
+            root = a
         elif o == "-d":
             recv_parent_fs = a
-    if len(args) < 1:
+        elif o == "-C":
+            cache_dir = a
+        elif o == "-M":
+            cache_size = parse_size(a)
+        elif o == "-E":
+            export_dir = a
+        elif o == "-P":
+            if not a.isdigit() or int(a) < 1:
+                usage(cmd, "invalid number of connections: {}".format(a))
+            streams = int(a)
+    if export_dir:
+        if len(args) > 1:
+            usage(cmd)
+    elif len(args) < 1 or (cmd == cmd_pull and len(args) > 1):
         usage(cmd)
-    remote_host = args[0] if args[0] != "local" else None
-    debug("remote_host: {}, name {}, recv_parent_fs: {}".format(remote_host, name, recv_parent_fs))
+    remote_hosts = map(lambda x: x if x != "local" else None, args)
+    debug("remote_hosts: {}, name {}, recv_parent_fs: {}".format(remote_hosts, name, recv_parent_fs))
 
     if cmd == cmd_push:
         send_host = None
-        recv_host = remote_host
+        recv_hosts = remote_hosts
     else:
-        send_host = remote_host
-        recv_host = None
-    send_filesystems = FS.list(send_host)
-    recv_filesystems = FS.list(recv_host)
-
-    for s in send_filesystems.itervalues():
-        if name and name not in s.name:
+        send_host = remote_hosts[0]
+        recv_hosts = [None]
+    send_filesystems = FS.list(send_host, root, name, bookmarks=True)
+    cache = StreamCache(cache_dir, cache_size) if cache_dir else None
+
+    if export_dir:
+        # plan against specified host (or nothing) and write streams to files
+        recv_filesystems = list_receiver(recv_hosts[0], recv_parent_fs, root, name) if recv_hosts else FS(None)
+        steps = plan_sync(send_filesystems, recv_filesystems, name, keep)
+        do_export(send_host, steps, StreamCache(export_dir), cache)
+        return
+
+    # plan each receiver separately
+    plans = collections.OrderedDict()
+    for recv_host in recv_hosts:
+        recv_filesystems = list_receiver(recv_host, recv_parent_fs, root, name)
+        plans[recv_host] = plan_sync(send_filesystems, recv_filesystems, name, keep)
+
+    sync_plans(send_host, plans, recv_parent_fs, cache, streams)
+
+def do_export(send_host, steps, export, cache=None):
+    """write plan streams to export directory
+The streams are listed in receive order in the export "manifest" file."""
+    manifest = []
+    for (from_snap, to_snap) in steps:
+        filename = export.filename(from_snap, to_snap)
+        manifest.append("{}\t{}".format(os.path.basename(filename), to_snap.name))
+        if export.get(from_snap, to_snap):
+            debug("export: {} already exists".format(filename))
             continue
-        s.sync(send_filesystems, recv_filesystems, recv_parent_fs)
+        # write to temporary file, so a failed send does not leave
+        # a truncated stream which would be taken as exported
+        cached = cache.get(from_snap, to_snap) if cache else None
+        if cached:
+            cmd = ["cp", cached, filename + ".tmp"]
+        else:
+            cmd = send_cmd(send_host, from_snap, to_snap)
+            if not use_noop:
+                cmd += [">", filename + ".tmp"]
+        if use_noop:
+            if cached:
+                print(' '.join(cmd))
+            else:
+                runshell(None, *cmd)
+            continue
+        try:
+            runshell(None, *cmd)
+        except SystemExit:
+            if os.path.exists(filename + ".tmp"):
+                os.unlink(filename + ".tmp")
+            raise
+        os.rename(filename + ".tmp", filename)
+    if use_noop:
+        return
+    with open(os.path.join(export.path, "manifest"), "w") as f:
+        for l in manifest:
+            print(l, file=f)
 
 def do_container_cmd(cmd, args, options="", allow_all=True):
     try:
@@ -360,13 +1243,22 @@ def do_container_cmd(cmd, args, options="", allow_all=True):
         ids = sets.Set(vms.iterkeys())
     else:
         usage(cmd)
+    selected = []
     for id in ids:
-        if id not in vms:
-            if id not in vms.names:
-                print("Container {} does not exist".format(id), file=sys.stderr)
-                continue
-            id = str(vms.names[id]["ctid"])
-        cmd.do(vms[id], other_opts)
+        vm = vms.find(id)
+        if vm is None:
+            print("Container {} does not exist".format(id), file=sys.stderr)
+            continue
+        selected.append(vm)
+
+    # process containers (in parallel if -j is specified)
+    if "-j" in other_opts:
+        results = run_parallel(map(lambda x: lambda: cmd.do(x, other_opts), selected),
+            int(other_opts["-j"]))
+    else:
+        results = map(lambda x: cmd.do(x, other_opts), selected)
+    if hasattr(cmd, "done"):
+        cmd.done(results, other_opts)
 
 def cmd_rebase(args):
     debug("rebase {}".format(args))
@@ -509,20 +1401,24 @@ def cmd_list(args):
     """list command"""
     debug("list {}".format(args))
     try:
-        opts, args = getopt.getopt(args, "n:p")
+        opts, args = getopt.getopt(args, "bn:pr:")
     except getopt.GetoptError as err:
         usage(cmd_list, err)
-    name, list_parents = None, False
+    name, list_parents, root, list_bookmarks = None, False, None, False
     for o, a in opts:
         if o == "-n":
             name = a
+        elif o == "-b":
+            list_bookmarks = True
         elif o == "-p":
             list_parents = True
+        elif o == "-r":
+            root = a
 
     def list_filesystem(s):
         if s.processed:
             return
-        if s.parent and list_parents:
+        if list_parents and s.get_parent():
             list_filesystem(s.parent)
 
         # print filesystem
@@ -531,8 +1427,11 @@ def cmd_list(args):
             l += " (origin: {})".format(s.origin)
         print(l)
 
-        # print snapshots
-        for snap in s.snapshots.itervalues():
+        # print snapshots (and bookmarks)
+        snapshots = s.snapshots.values()
+        if list_bookmarks:
+            snapshots = sorted(snapshots + s.bookmarks.values(), key=lambda x: int(x.createtxg))
+        for snap in snapshots:
             l = "\t{}".format(snap.name)
             if use_verbose:
                 l += " (createtxg: {}, guid: {})".format(snap.createtxg, snap.guid)
@@ -540,13 +1439,15 @@ def cmd_list(args):
 
         s.processed = True
 
-    filesystems = FS.list(None if len(args) < 1 else args[0])
+    filesystems = FS.list(None if len(args) < 1 else args[0], root, name, list_bookmarks)
     for s in sorted(filesystems.values(), key=lambda x: x.name):
         if name and name not in s.name:
             continue
         list_filesystem(s)
-cmd_list.usage = """list [-n name] [-p] [[user@]host]
+cmd_list.usage = """list [-n name] [-r root] [-p] [-b] [[user@]host]
     -n  list only snapshots with specified name
+    -r  list only filesystems under specified dataset
+    -b  include bookmarks
     -p  include parents"""
 commands["list"] = cmd_list
 
@@ -556,18 +1457,30 @@ def cmd_pull(args):
     """pull command"""
     debug("pull {}".format(args))
     do_sync(cmd_pull, args)
-cmd_pull.usage = """pull [-n name] [-d local-dest-fs] [user@]host
+cmd_pull.usage = """pull [-n name] [-r root] [-d local-dest-fs] [-c keep] [-P streams] [-C cache-dir [-M size]] [user@]host
     -n  pull only snapshots with specified name
-    -d  specify local destination filesystem"""
+    -r  pull only filesystems under specified dataset
+    -d  specify local destination filesystem
+    -c  catch up: pull only the specified number of newest missing snapshots
+    -P  pull full streams over specified number of parallel ssh connections
+    -C  replay send streams from (and store them to) cache directory
+    -M  max cache size (e.g. 100G, default: unbounded)"""
 commands["pull"] = cmd_pull
 
 def cmd_push(args):
     """push command"""
     debug("push {}".format(args))
     do_sync(cmd_push, args)
-cmd_push.usage = """push [-n name] [-d remote-dest-fs] [user@]host
+cmd_push.usage = """push [-n name] [-r root] [-d remote-dest-fs] [-c keep] [-P streams] [-C cache-dir [-M size]] [user@]host...
+       push [-n name] [-r root] [-c keep] [-C cache-dir] -E export-dir [[user@]host]
     -n  push only snapshots with specified name
-    -d  specify remote destination filesystem"""
+    -r  push only filesystems under specified dataset
+    -d  specify remote destination filesystem
+    -c  catch up: push only the specified number of newest missing snapshots
+    -P  push full streams over specified number of parallel ssh connections
+    -C  replay send streams from (and store them to) cache directory
+    -M  max cache size (e.g. 100G, default: unbounded)
+    -E  write streams missing on host (all streams if no host) to export directory"""
 commands["push"] = cmd_push
 
 ###########################################################################
@@ -645,7 +1558,54 @@ commands["checkpoint"] = cmd_checkpoint
 
 ###########################################################################
 # clone
-def do_clone(vm, opts={}):
+def reserve_ctid(ctid):
+    """reserve container id by creating empty container config, so concurrent
+allocations do not pick the same id
+:returns: False if the id is already taken
+:rtype: bool"""
+    if use_noop:
+        return True
+    conf_filename = os.path.join(VM.VZ_CONF_DIR, "{}.conf".format(ctid))
+    if runcmd(None, "sh", "-c", "set -C; : > {}".format(pipes.quote(conf_filename)),
+            check=False) is None:
+        debug("clone: ctid {} is already taken".format(ctid))
+        return False
+    return True
+
+def release_ctids(ctids, created={}):
+    """release reserved container ids which configs were not written yet
+Filesystems already cloned for them are destroyed first, ids which
+filesystems can't be destroyed are kept reserved.
+:param created: ctid -> list of cloned filesystems
+:type created: dict"""
+    if use_noop:
+        return
+    for ctid in ctids:
+        conf_filename = os.path.join(VM.VZ_CONF_DIR, "{}.conf".format(ctid))
+        if not os.path.isfile(conf_filename) or os.path.getsize(conf_filename) != 0:
+            continue
+        # children first
+        left = filter(lambda x: runcmd(None, "zfs", "destroy", x, check=False) is None,
+            reversed(created.get(ctid, [])))
+        if left:
+            print("Filesystems {} of container {} could not be destroyed, keeping ctid {} reserved".format(
+                ", ".join(left), ctid, ctid), file=sys.stderr)
+            continue
+        debug("clone: releasing ctid {}".format(ctid))
+        runcmd(None, "rm", "-f", conf_filename, check=False)
+
+def allocate_ctids(vms, count):
+    """allocate (and reserve) new container ids"""
+    ctids = []
+    ctid = reduce(lambda x, y: max(x, int(y)), vms.iterkeys(), 0)
+    while len(ctids) < count:
+        ctid += 1
+        if str(ctid) in vms or not reserve_ctid(ctid):
+            continue
+        ctids.append(str(ctid))
+    return ctids
+
+def do_clone(vm, opts={}, vms=None):
     # determine source snapshot
     if "-s" in opts:
         # operate on specified snapshot
@@ -668,114 +1628,372 @@ def do_clone(vm, opts={}):
         # create a new snapshot
         snapname = do_checkpoint(vm, opts)
 
-    # determine ctid
-    vms = VM.list()
+    # determine ctids
+    if vms is None:
+        vms = VM.list()
     if "-i" in opts:
-        new_ctid = opts["-i"]
+        new_ctids = opts["-i"].split(",")
+        for new_ctid in new_ctids:
+            if new_ctid in vms:
+                print("Container {} already exists".format(new_ctid))
+                return None
+        reserved = []
+        for new_ctid in new_ctids:
+            if not reserve_ctid(new_ctid):
+                print("Container {} already exists".format(new_ctid))
+                release_ctids(reserved)
+                return None
+            reserved.append(new_ctid)
     else:
-        new_ctid = str(reduce(lambda x, y: max(x, int(y)), vms.iterkeys(), 0) + 1)
-    if new_ctid in vms:
-        print("Container {} already exists".format(new_ctid))
-        return None
-
-    def make_new_name(old_name):
-        return (old_name+"/").replace("/{}/".format(vm["ctid"]), "/{}/".format(new_ctid)).rstrip("/")
+        new_ctids = allocate_ctids(vms, int(opts.get("-c", 1)))
+    created = collections.defaultdict(list)
+    try:
+        return clone_containers(vm, opts, snapname, new_ctids, created)
+    except SystemExit:
+        # do not leave reservations (and filesystems) of containers which
+        # were not created
+        release_ctids(new_ctids, created)
+        raise
+
+def clone_containers(vm, opts, snapname, new_ctids, created):
+    """clone container snapshot to containers with reserved ids
+:param created: dict to add cloned filesystems to (ctid -> list)
+:type created: dict"""
+    new_names = opts["-n"].split(",") if "-n" in opts else []
+    if len(new_names) == 1 and len(new_ctids) > 1:
+        new_names = map(lambda x: "{}-{}".format(new_names[0], x), new_ctids)
+    elif new_names and len(new_names) != len(new_ctids):
+        print("Number of names does not match number of containers", file=sys.stderr)
+        sys.exit(1)
+    jobs = int(opts.get("-j", 4))
 
-    debug("clone: new ctid {}, source snapshot {}".format(new_ctid, snapname))
+    debug("clone: new ctids {}, source snapshot {}".format(new_ctids, snapname))
 
-    (fs, snap) = snapname.split("@")
-    # clone filesystems (recursively)
-    suspended = False
-    for l in runcmd(None, "zfs", "list", "-H", "-r", "-o", "name,mountpoint", fs).split("\n"):
-        if not l:
-            continue
-        (_fs, _mountpoint) = l.split("\t")
-        new_fs = make_new_name(_fs)
-        cmd = ["zfs", "clone", "{}@{}".format(_fs, snap), new_fs]
+    def run(cmd):
         if use_noop:
             print(' '.join(cmd))
         else:
             runshell(False, *cmd)
 
-        # rename dump if any
-        if new_fs.endswith("/Dump"):
-            new_mountpoint = make_new_name(_mountpoint)
-            dump_filename = os.path.join(new_mountpoint, "Dump.{}".format(vm["ctid"]))
-            if os.path.exists(dump_filename):
-                new_dump_filename = os.path.join(new_mountpoint, "Dump.{}".format(new_ctid))
-                cmd = ["mv", dump_filename, new_dump_filename]
-                if use_noop:
-                    print(' '.join(cmd))
-                else:
-                    runshell(False, *cmd)
-                suspended = True
-
-    # create new container configuration
+    (fs, snap) = snapname.split("@")
+    datasets = []
+    for l in runcmd(None, "zfs", "list", "-H", "-r", "-o", "name,mountpoint", fs).split("\n"):
+        if not l:
+            continue
+        datasets.append(l.split("\t"))
+
+    def clone(new_ctid):
+        def make_new_name(old_name):
+            return (old_name+"/").replace("/{}/".format(vm["ctid"]), "/{}/".format(new_ctid)).rstrip("/")
+
+        # clone filesystems (recursively)
+        suspended = False
+        for (_fs, _mountpoint) in datasets:
+            new_fs = make_new_name(_fs)
+            run(["zfs", "clone", "{}@{}".format(_fs, snap), new_fs])
+            created[new_ctid].append(new_fs)
+
+            # rename dump if any
+            if new_fs.endswith("/Dump"):
+                new_mountpoint = make_new_name(_mountpoint)
+                dump_filename = os.path.join(new_mountpoint, "Dump.{}".format(vm["ctid"]))
+                if os.path.exists(dump_filename):
+                    new_dump_filename = os.path.join(new_mountpoint, "Dump.{}".format(new_ctid))
+                    run(["mv", dump_filename, new_dump_filename])
+                    suspended = True
+        return suspended
+
+    # clone filesystems of all containers
+    suspended = run_parallel(map(lambda x: lambda: clone(x), new_ctids), jobs)
+
+    # create new container configurations
     conf_filename = os.path.join(VM.VZ_CONF_DIR, "{}.conf".format(vm["ctid"]))
-    new_conf_filename = os.path.join(VM.VZ_CONF_DIR, "{}.conf".format(new_ctid))
-    cmd = ["cp", "-a", conf_filename, new_conf_filename]
-    if use_noop:
-        print(' '.join(cmd))
-    else:
-        runshell(False, *cmd)
+    new_conf_filenames = map(lambda x: os.path.join(VM.VZ_CONF_DIR, "{}.conf".format(x)), new_ctids)
+    run(["tee"] + new_conf_filenames + ["<", conf_filename, ">", "/dev/null"])
 
-    # start new container if old container was running
+    def vzctl(*args):
+        return lambda: run(["vzctl"] + list(args))
+
+    # set new container names
+    if new_names:
+        run_parallel(map(lambda x: vzctl("set", x[0], "--name", x[1], "--save"),
+            zip(new_ctids, new_names)), jobs)
+
+    # start new containers if old container was running
     if vm["status"] == "running":
-        if suspended:
-            cmd = ["vzctl", "resume", new_ctid]
-        else:
-            cmd = ["vzctl", "start", new_ctid]
-        if use_noop:
-            print(' '.join(cmd))
-        else:
-            runshell(False, *cmd)
+        run_parallel(map(lambda x: vzctl("resume" if x[1] else "start", x[0]),
+            zip(new_ctids, suspended)), jobs)
+
+    return new_ctids
 
 def cmd_clone(args):
     """clone command"""
     debug("clone {}".format(args))
-    do_container_cmd(cmd_clone, args, "d:Si:n:s:", allow_all=False)
-cmd_clone.do = do_clone
-cmd_clone.usage = """clone [-s snapshot] [-i id] [-n name] [-S] [-d description] ctid
+    try:
+        opts, args = getopt.getopt(args, "c:d:Si:j:n:s:")
+    except getopt.GetoptError as err:
+        usage(cmd_clone, err)
+    if len(args) != 1:
+        usage(cmd_clone)
+    opts = dict(opts)
+    for (o, what) in (("-c", "number of containers"), ("-j", "number of jobs")):
+        if o in opts and (not opts[o].isdigit() or int(opts[o]) < 1):
+            usage(cmd_clone, "invalid {}: {}".format(what, opts[o]))
+
+    vms = VM.list()
+    vm = vms.find(args[0])
+    if vm is None:
+        print("Container {} does not exist".format(args[0]), file=sys.stderr)
+        sys.exit(1)
+    do_clone(vm, opts, vms)
+cmd_clone.usage = """clone [-s snapshot] [-c count | -i id[,id...]] [-n name[,name...]] [-j jobs] [-S] [-d description] ctid
     -s  source container snapshot (default: clone from live container)
-    -i  new container id (default: allocate next unused ctid)
-    -n  new container name
+    -c  number of containers to create (default: 1)
+    -i  new container ids (default: allocate next unused ctids)
+    -n  new container names (single name is suffixed with ctid for several containers)
+    -j  number of containers to clone/start in parallel (default: 4)
     -S  fully stop the container before making snapshot
     -d  new snapshot description"""
 commands["clone"] = cmd_clone
 
+###########################################################################
+# migrate
+def do_migrate(vm, opts, host):
+    privatefs = vm.get("privatefs")
+    if privatefs is None:
+        print("Container {} private area is not on ZFS".format(vm["ctid"]), file=sys.stderr)
+        sys.exit(1)
+    snapfs = vm.get("parentfs") or privatefs
+    recv_parent_fs = opts.get("-d")
+    threshold = parse_size(opts.get("-t", "64M"))
+    max_rounds = int(opts.get("-r", 5))
+    stop = opts.get("-S") is not None
+
+    def replicated(path):
+        # path is on a filesystem within the synced tree
+        path = os.path.realpath(path)
+        fs = None
+        for (mountpoint, f) in snapfs.filesystems.mountpoints.iteritems():
+            if path == mountpoint or path.startswith(mountpoint.rstrip("/") + "/"):
+                if fs is None or len(mountpoint) > len(fs.mountpoint):
+                    fs = f
+        return fs is not None and (fs.name + "/").startswith(snapfs.name + "/")
+
+    # the dump of suspended container is copied explicitly when it is not
+    # synced together with the filesystems
+    dumpfile = None
+    if not stop and vm["status"] == "running":
+        if not vm.get("dumpdir"):
+            print("Container {} DUMPDIR is not set, use -S to stop it instead of suspending".format(
+                vm["ctid"]), file=sys.stderr)
+            sys.exit(1)
+        if not replicated(vm["dumpdir"]):
+            dumpfile = "{}/Dump.{}".format(vm["dumpdir"], vm["ctid"])
+            debug("migrate: {} is not synced, copying it".format(dumpfile))
+
+    def sync():
+        # relist container filesystems only and sync them
+        send_filesystems = FS.list(None, snapfs.name, bookmarks=True)
+        vm["privatefs"] = send_filesystems.get(privatefs.name)
+        if vm.get("parentfs"):
+            vm["parentfs"] = send_filesystems.get(snapfs.name)
+        recv_filesystems = list_receiver(host, recv_parent_fs, snapfs.name)
+        sync_plans(None, {host: plan_sync(send_filesystems, recv_filesystems)}, recv_parent_fs)
+
+    def pending():
+        # bytes written since the last snapshot
+        output = runcmd(None, "zfs", "get", "-H", "-p", "-r", "-t", "filesystem",
+            "-o", "value", "written", snapfs.name)
+        return sum(map(int, filter(lambda x: x.isdigit(), output.split("\n"))))
+
+    # pre-copy rounds while the container is running
+    rounds, last = 0, None
+    while vm["status"] == "running" and not use_noop:
+        rounds += 1
+        t = time.time()
+        do_snapshot(vm, "migrate{}".format(rounds))
+        sync()
+        left = pending()
+        print("Round {}: synced in {:.1f}s, {} bytes changed meanwhile".format(
+            rounds, time.time() - t, left))
+        if left <= threshold or rounds >= max_rounds or (last is not None and left >= last):
+            break
+        last = left
+
+    def copy_file(filename):
+        cmd = ["cat", filename, "|"] + hostcmd(host, "tee", filename) + [">", "/dev/null"]
+        if use_noop:
+            print(' '.join(cmd))
+        else:
+            runshell(None, *cmd)
+
+    # final round: stop/suspend container and send the rest (with the dump)
+    t = time.time()
+    if stop:
+        suspended = do_stop(vm)
+    else:
+        suspended = do_suspend(vm)
+    try:
+        do_snapshot(vm, "migrate")
+        sync()
+
+        # copy configuration (and dump), mount filesystems and start container on target
+        copy_file(os.path.join(VM.VZ_CONF_DIR, "{}.conf".format(vm["ctid"])))
+        if suspended and dumpfile:
+            runcmd(host, "mkdir", "-p", vm["dumpdir"])
+            copy_file(dumpfile)
+        recv_filesystems = FS(host)
+        recv_filesystems.recv_parent_fs = recv_parent_fs
+        recv_fs = recv_filesystems.recv_name(snapfs.name)
+        for fsname in (runcmd(host, "zfs", "list", "-H", "-r", "-o", "name", recv_fs, check=False) or "").split("\n"):
+            if not fsname:
+                continue
+            cmd = ["zfs", "mount", fsname]
+            if use_noop:
+                print(' '.join(hostcmd(host, *cmd)))
+            else:
+                runcmd(host, *cmd, check=False)     # may be mounted already
+        if suspended:
+            cmd = ["vzctl", "resume" if not stop else "start", str(vm["ctid"])]
+            if use_noop:
+                print(' '.join(hostcmd(host, *cmd)))
+            else:
+                runcmd(host, *cmd)
+    except SystemExit:
+        # do not leave the container down
+        if suspended:
+            print("Migration of container {} failed, restoring it on source".format(vm["ctid"]),
+                file=sys.stderr)
+            runcmd(None, "vzctl", "resume" if not stop else "start", str(vm["ctid"]), check=False)
+        raise
+    if suspended:
+        print("Container {} migrated to {}, downtime {:.1f}s".format(
+            vm["ctid"], host or "localhost", time.time() - t))
+    else:
+        print("Container {} migrated to {}".format(vm["ctid"], host or "localhost"))
+
+def cmd_migrate(args):
+    """migrate command"""
+    debug("migrate {}".format(args))
+    try:
+        opts, args = getopt.getopt(args, "d:r:St:")
+    except getopt.GetoptError as err:
+        usage(cmd_migrate, err)
+    for o, a in opts:
+        if o == "-r":
+            if not a.isdigit() or int(a) < 1:
+                usage(cmd_migrate, "invalid number of rounds: {}".format(a))
+        elif o == "-t":
+            try:
+                parse_size(a)
+            except ValueError:
+                usage(cmd_migrate, "invalid size: {}".format(a))
+    if len(args) != 2:
+        usage(cmd_migrate)
+
+    vm = VM.list().find(args[0])
+    if vm is None:
+        print("Container {} does not exist".format(args[0]), file=sys.stderr)
+        sys.exit(1)
+    do_migrate(vm, dict(opts), args[1] if args[1] != "local" else None)
+cmd_migrate.usage = """migrate [-d remote-dest-fs] [-t size] [-r rounds] [-S] ctid [user@]host
+    -d  specify remote destination filesystem
+    -t  suspend container when less than size is left to sync (default: 64M)
+    -r  max number of pre-copy rounds (default: 5)
+    -S  fully stop the container instead of suspending it"""
+commands["migrate"] = cmd_migrate
+
 ###########################################################################
 # diff
 def do_diff(vm, opts={}):
     fs = vm.get("privatefs")
     if fs is None:
         return False
+    summary = "-c" in opts or "-J" in opts
+
+    def error(msg):
+        # summary of other containers is printed (and failure reported) by done_diff
+        print(msg, file=sys.stderr)
+        if not summary:
+            sys.exit(1)
+
     snapname = opts.get("-s")
     if snapname:
         snapfrom = fs.find_snapshot(snapname, fuzzy=True)
         if snapfrom is None:
-            print("No snapshots like {} found for {}".format(snapname, fs.mountpoint), file=sys.stderr) 
-            sys.exit(1)
+            error("No snapshots like {} found for {}".format(snapname, fs.mountpoint))
+            return None
     else:
         snapfrom = fs.last_snapshot()
         if snapfrom is None:
-            print("{} does not have snapshots".format(fs.mountpoint), file=sys.stderr)
-            sys.exit(1)
+            error("{} does not have snapshots".format(fs.mountpoint))
+            return None
     snapname = opts.get("-S")
     snapto = None
     if snapname:
         snapto = fs.find_snapshot(snapname, fuzzy=True)
         if snapto is None:
-            print("No snapshots like {} found for {}".format(snapname, fs.mountpoint), file=sys.stderr) 
-            sys.exit(1)
-    return runshell(False, "zfs", "diff", "-F", "-t", snapfrom.name, fs.name if snapto is None else snapto.name)
+            error("No snapshots like {} found for {}".format(snapname, fs.mountpoint))
+            return None
+    target = fs.name if snapto is None else snapto.name
+    cmd = ["zfs", "diff", "-F", "-t", snapfrom.name, target]
+    if not summary:
+        if "-j" not in opts:
+            return runshell(False, *cmd)
+        # do not mix output of parallel diffs
+        output = runshell(True, *cmd)
+        with print_lock:
+            print("==> {} ({})".format(vm["ctid"], vm["name"]))
+            sys.stdout.write(output)
+            sys.stdout.flush()
+        return True
+
+    # count changes by type
+    stats = collections.OrderedDict([
+        ("ctid", vm["ctid"]), ("name", vm["name"]),
+        ("from", snapfrom.name), ("to", target),
+        ("added", 0), ("modified", 0), ("removed", 0), ("renamed", 0)])
+    changes = {"+": "added", "M": "modified", "-": "removed", "R": "renamed"}
+    try:
+        output = runshell(True, *cmd)
+    except SystemExit:
+        return None     # failure is reported by done_diff
+    for l in output.split("\n"):
+        # 1437137455.312919516  M  F  /pool/vm/101/etc/passwd
+        fields = l.split("\t")
+        if len(fields) > 1 and fields[1] in changes:
+            stats[changes[fields[1]]] += 1
+    written = runcmd(None, "zfs", "get", "-H", "-p", "-o", "value",
+        "written@" + snapfrom.name.split("@")[1], target).strip()
+    stats["written"] = int(written) if written.isdigit() else 0
+    return stats
+
+def done_diff(results, opts):
+    """print diff summary (most written first)"""
+    stats = sorted(filter(lambda x: isinstance(x, dict), results),
+        key=lambda x: x["written"], reverse=True)
+    if "-J" in opts:
+        print(json.dumps(stats, indent=2, separators=(",", ": ")))
+    elif "-c" in opts:
+        fmt = "{ctid:>8} {name:<20} {added:>8} {modified:>8} {removed:>8} {renamed:>8} {written:>14}"
+        print(fmt.format(ctid="CTID", name="NAME", added="ADDED", modified="MODIFIED",
+            removed="REMOVED", renamed="RENAMED", written="WRITTEN"))
+        for s in stats:
+            print(fmt.format(**s))
+    if ("-c" in opts or "-J" in opts) and None in results:
+        sys.exit(1)     # some containers failed (errors are printed already)
 
 def cmd_diff(args):
     """diff command"""
     debug("diff {}".format(args))
-    do_container_cmd(cmd_diff, args, "s:S:")
+    do_container_cmd(cmd_diff, args, "cj:Js:S:")
 cmd_diff.do = do_diff
-cmd_diff.usage = """diff [-s snapname] [-S snapname] [ctid...]
+cmd_diff.done = done_diff
+cmd_diff.usage = """diff [-c | -J] [-j jobs] [-s snapname] [-S snapname] [ctid...]
     -a  diff all
+    -c  print summary of changes and bytes written per container
+    -J  print summary in JSON
+    -j  number of containers to diff in parallel
     -s  diff from snapshot (default: last snapshot)
     -S  diff to snapshot (default: live filesystem)"""
 commands["diff"] = cmd_diff
@@ -867,6 +2085,158 @@ cmd_resume.usage = """resume [-a] [ctid...]
     -a  resume all"""
 commands["resume"] = cmd_resume
 
+###########################################################################
+# agent
+def cmd_agent(args):
+    """agent command"""
+    try:
+        opts, args = getopt.getopt(args, "bn:r:")
+    except getopt.GetoptError as err:
+        usage(cmd_agent, err)
+    name, root, bookmarks = None, None, False
+    for o, a in opts:
+        if o == "-n":
+            name = a
+        elif o == "-r":
+            root = a
+        elif o == "-b":
+            bookmarks = True
+
+    data = FS.list(None, root, name, bookmarks).dump()
+    sys.stdout.write(zlib.compress(json.dumps(data, separators=(",", ":")), 9))
+cmd_agent.usage = """agent [-r root] [-n name] [-b]
+    print compressed inventory (run by zfs-vm on remote hosts with -a)
+    -r  list only filesystems under specified dataset
+    -n  list only filesystems with specified name
+    -b  include bookmarks"""
+commands["agent"] = cmd_agent
+
+###########################################################################
+# multi-stream transport
+def open_fifos(fifos, mode, timeout=MULTISTREAM_CONNECT_TIMEOUT):
+    """open fifos concurrently
+Opens of fifos not connected by the other side until timeout are released
+(by opening the other side of the fifo) and all fifos are closed.
+:param mode: open mode ("rb" or "wb")
+:type mode: str
+:returns: opened files (None if not all fifos are connected)
+:rtype: list of file"""
+    def opener(i):
+        files[i] = open(fifos[i], mode)
+
+    files = [None] * len(fifos)
+    threads = []
+    for i in range(len(fifos)):
+        t = threading.Thread(target=opener, args=(i,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    deadline = time.time() + timeout
+    for t in threads:
+        t.join(max(0, deadline - time.time()))
+    if all(files):
+        return files
+
+    for (fifo, t) in zip(fifos, threads):
+        if t.is_alive():
+            debug("open_fifos: {} is not connected".format(fifo))
+            try:
+                os.close(os.open(fifo, os.O_NONBLOCK |
+                    (os.O_WRONLY if mode.startswith("r") else os.O_RDONLY)))
+            except OSError:
+                pass
+    for t in threads:
+        t.join()
+    for f in files:
+        if f:
+            f.close()
+    return None
+
+def cmd_stream(args):
+    """stream command"""
+    try:
+        opts, args = getopt.getopt(args, "n:")
+    except getopt.GetoptError as err:
+        usage(cmd_stream, err)
+    streams = 1
+    for o, a in opts:
+        if o == "-n":
+            streams = int(a)
+    if len(args) < 2 or args[0] not in ("split", "join"):
+        usage(cmd_stream)
+    (mode, cmd) = (args[0], args[1:])
+
+    # remove fifos when killed (e.g. by the ssh session end)
+    def terminate(signum, frame):
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, terminate)
+
+    # the connections read or write fifos listed in the reported directory
+    path = tempfile.mkdtemp(prefix="zfs-vm-")
+    try:
+        fifos = map(lambda x: os.path.join(path, str(x)), range(streams))
+        for fifo in fifos:
+            os.mkfifo(fifo)
+        print(path)
+        sys.stdout.flush()
+        conns = open_fifos(fifos, "wb" if mode == "split" else "rb")
+        if conns is None:
+            print("Connections to {} timed out".format(path), file=sys.stderr)
+            sys.exit(1)
+        if mode == "split":
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            ok = split_stream(p.stdout, conns)
+            p.stdout.close()
+        else:
+            # stdout is used for reporting only
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=sys.stderr)
+            ok = join_stream(conns, p.stdin)
+            p.stdin.close()
+    finally:
+        shutil.rmtree(path)
+    if p.wait() != 0 or not ok:
+        sys.exit(1)
+cmd_stream.usage = """stream [-n streams] split|join cmd [args...]
+    split output of cmd to (or join input of cmd from) fifos read (written)
+    by parallel connections (run by zfs-vm on remote hosts with push/pull -P)
+    -n  number of connections"""
+commands["stream"] = cmd_stream
+
+def cmd_bench(args):
+    """bench command"""
+    try:
+        opts, args = getopt.getopt(args, "n:s:")
+    except getopt.GetoptError as err:
+        usage(cmd_bench, err)
+    max_streams, size = 8, 1024 * 1024 * 1024
+    for o, a in opts:
+        if o == "-n":
+            max_streams = int(a)
+        elif o == "-s":
+            size = parse_size(a)
+    if len(args) > 1:
+        usage(cmd_bench)
+    host = args[0] if args else "localhost"
+
+    print("{:>8} {:>10} {:>10}".format("STREAMS", "SECONDS", "MB/S"))
+    streams = 1
+    while streams <= max_streams:
+        start = time.time()
+        if not multistream(host, streams, ["head", "-c", str(size), "/dev/zero"],
+                ["sh", "-c", pipes.quote("cat > /dev/null")]):
+            exit(1)
+        elapsed = time.time() - start
+        print("{:>8} {:>10.2f} {:>10.1f}".format(streams, elapsed, size / elapsed / 1024 / 1024))
+        sys.stdout.flush()
+        streams *= 2
+cmd_bench.usage = """bench [-n streams] [-s size] [[user@]host]
+    measure multi-stream transport throughput to host (default: localhost)
+    with 1, 2, 4... parallel connections
+    -n  max number of connections (default: 8)
+    -s  amount of data to send (default: 1G)"""
+commands["bench"] = cmd_bench
+
 ###########################################################################
 # usage
 def usage(cmd=None, error=None):
@@ -878,9 +2248,10 @@ def usage(cmd=None, error=None):
 
     name = os.path.basename(sys.argv[0])
     if cmd is None:
-        print("""Usage: {name} [-dnsv] <command> [args...]
+        print("""Usage: {name} [-adnsv] <command> [args...]
 
 Options:
+-a  list remote hosts with the inventory agent (requires python on remote)
 -d  debug
 -n  no-op
 -s  use sudo when executing remote commands
@@ -903,13 +2274,15 @@ def main(args):
 
     # parse command-line options
     try:
-        opts, args = getopt.getopt(args[1:], "dhnsv")
+        opts, args = getopt.getopt(args[1:], "adhnsv")
     except getopt.GetoptError as err:
         usage(error=err)
 
-    global use_sudo, use_debug, use_verbose, use_noop
+    global use_sudo, use_debug, use_verbose, use_noop, use_agent
     for o, a in opts:
-        if o == "-d":
+        if o == "-a":
+            use_agent = True
+        elif o == "-d":
             use_debug = True
         elif o == "-h":
             usage()